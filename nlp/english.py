@@ -10,12 +10,16 @@ import ast
 # 5. colab based - https://huggingface.co/webbigdata/ALMA-7B-Ja-V2-GPTQ-Ja-En; https://github.com/webbigdata-jp/python_sample/blob/main/ALMA_7B_Ja_Free_Colab_sample.ipynb
 #    - batch translation, https://github.com/webbigdata-jp/python_sample/blob/main/ALMA_7B_Ja_GPTQ_Ja_En_batch_translation_sample.ipynb
 # 6. deeplx + docker: https://deeplx.owo.network/install/
+# 7. local (offline) translation, see `LocalTranslator`: a phrase table built from previous mappings,
+#    e.g. `data/translated-ing-mapping.xlsx`, with an optional CPU-only model (NLLB) for the misses
 
 import json
 import re
 
 from copy import deepcopy
 from pathlib import Path
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 import httpx
 import numpy as np
@@ -23,7 +27,8 @@ import numpy as np
 from openai import OpenAI
 
 CONFIG_FILE = Path('config-local.json')
-CONFIG = json.loads(CONFIG_FILE.read_text(encoding='utf8'))
+# NB. the config is only required for online translators, e.g. openai
+CONFIG = json.loads(CONFIG_FILE.read_text(encoding='utf8')) if CONFIG_FILE.exists() else {}
 
 
 def deeplx(text: str, src_lang='JP', tar_lang='EN'):
@@ -64,11 +69,169 @@ def openaix(client,
     return response.choices[0].message.content
 
 
+class Translator(ABC):
+    """
+    The interface of translators that `quick_translate` can target. A translator maps a batch of
+    source texts into a dict of `{source: translated}`, and untranslated texts are left out.
+    """
+    # NB. whether batches can be translated at the same time, e.g. I/O-bound translators
+    parallel = True
+
+    def lookup(self, texts: list) -> dict:
+        """Translations that are already known without inference, nothing by default"""
+        return {}
+
+    @abstractmethod
+    def translate(self, texts: list) -> dict:
+        pass
+
+
+class DeepLXTranslator(Translator):
+    """Translate texts one by one through a local DeepLX server"""
+
+    def __init__(self, src_lang='JP', tar_lang='EN'):
+        self.src_lang = src_lang
+        self.tar_lang = tar_lang
+
+    def translate(self, texts: list) -> dict:
+        results = {}
+        for text in texts:
+            r = json.loads(deeplx(text, self.src_lang, self.tar_lang))
+            if r.get('data'):
+                results[text] = r['data']
+
+        return results
+
+
+class LocalTranslator(Translator):
+    """
+    CPU-only offline translator. Texts are looked up in a phrase table built from previously translated
+    mappings first and, if a local model is given, the misses are translated by the model and put
+    back into the table so that repeated entries are never translated twice.
+    The model requires `transformers`, `torch` and `sentencepiece` installed, and it runs one batch
+    at a time because torch already uses all CPU cores within one call.
+
+    :param mapping: a dict of {source: translated}, or a mapping file with `source` and `translated` columns
+    :param model: name of a local huggingface model, e.g. `facebook/nllb-200-distilled-600M`, default None
+    :param src_lang: source language code of the model, default `jpn_Jpan`
+    :param tar_lang: target language code of the model, default `eng_Latn`
+    :param max_length: the maximum length of generated translations, default 128
+    """
+    parallel = False
+
+    def __init__(self,
+                 mapping=None,
+                 model: str = None,
+                 src_lang: str = 'jpn_Jpan',
+                 tar_lang: str = 'eng_Latn',
+                 max_length: int = 128):
+        if mapping is None:
+            mapping = {}
+        elif isinstance(mapping, (str, Path)):
+            mapping = self.load_mapping(mapping)
+
+        self.table = {k.strip(): v for k, v in mapping.items() if isinstance(k, str) and isinstance(v, str)}
+        self.model = model
+        self.src_lang = src_lang
+        self.tar_lang = tar_lang
+        self.max_length = max_length
+        self._pipe = None
+
+    @staticmethod
+    def load_mapping(file) -> dict:
+        """Load a mapping file (.xlsx/.csv) created by the translation, e.g. `translated-ing-mapping.xlsx`"""
+        import pandas as pd
+
+        file = Path(file)
+        rows = pd.read_excel(file) if file.suffix in ['.xlsx', '.xls'] else pd.read_csv(file, encoding='utf8')
+        rows = rows.dropna(subset=['source', 'translated']).drop_duplicates(subset='source', keep='last')
+        return dict(zip(rows['source'], rows['translated']))
+
+    def update(self, results):
+        """Put translated results, a dict or a list of dicts returned by `quick_translate`, into the table"""
+        for each in (results if isinstance(results, list) else [results]):
+            if isinstance(each, dict):
+                self.table.update({k.strip(): v for k, v in each.items() if isinstance(v, str)})
+
+    def _pipeline(self):
+        # NB. lazy loading, `transformers` is only needed when a local model is used
+        if self._pipe is None:
+            from transformers import pipeline
+
+            self._pipe = pipeline('translation', model=self.model, device=-1,  # -1 means CPU-only
+                                  src_lang=self.src_lang, tgt_lang=self.tar_lang, max_length=self.max_length)
+        return self._pipe
+
+    def lookup(self, texts: list) -> dict:
+        return {t: self.table[t.strip()] for t in texts if t.strip() in self.table}
+
+    def translate(self, texts: list) -> dict:
+        results = self.lookup(texts)
+        misses = [t for t in texts if t not in results]
+        if misses and self.model is not None:
+            feeds = self._pipeline()(misses, batch_size=len(misses))
+            for src, feed in zip(misses, feeds):
+                results[src] = feed['translation_text']
+                self.table[src.strip()] = feed['translation_text']
+
+        return results
+
+
+def batch_translate(translator: Translator,
+                    items: list,
+                    batch_size: int = 32,
+                    workers: int = 4) -> dict:
+    """
+    Deduplicate items, look up the known translations and translate the rest in batches.
+    Batches run across a pool of workers only if the translator is `parallel`, e.g. DeepLX,
+    otherwise, e.g. a local model, they run one at a time and `workers` is ignored.
+
+    :param translator: a `Translator` instance
+    :param items: a list of texts for translation
+    :param batch_size: the number of texts in one batch of inference, default 32
+    :param workers: the number of workers in the pool, default 4
+    :return: dict, {source: translated} with the original items as keys
+    """
+    # NB. deduplicate on stripped texts, keep the order of first appearance and skip invalid entries
+    items = [t for t in items if isinstance(t, str) and t.strip()]
+    texts = list(dict.fromkeys(t.strip() for t in items))
+    results = translator.lookup(texts)
+    misses = [t for t in texts if t not in results]
+    batches = [misses[i: i + batch_size] for i in range(0, len(misses), batch_size)]
+    if translator.parallel:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for r in pool.map(translator.translate, batches):
+                results.update(r)
+    else:
+        for batch in batches:
+            results.update(translator.translate(batch))
+
+    return {t: results[t.strip()] for t in items if t.strip() in results}
+
+
+def easy_clean(x: str):
+    """Drop invalid texts before translation, e.g. `id:123` or those without any word"""
+    if re.findall(r'id:\d+', x):
+        return np.nan
+
+    if len(re.findall(r'[\d\w]{2,}', x)) == 0:
+        return np.nan
+
+    return x
+
+
 def quick_translate(client,
                     items: list,
                     max_input: int = 500,
                     **kwargs):
-    """To maximise the use of tokens, the function merges snippets and do translation for all"""
+    """
+    To maximise the use of tokens, the function merges snippets and do translation for all.
+    If `client` is a `Translator`, e.g. `LocalTranslator`, items are deduplicated and translated
+    by `batch_translate` with `batch_size` and `workers` passed in kwargs.
+    """
+    if isinstance(client, Translator):
+        return [batch_translate(client, items, **kwargs)]
+
     init = ''
     results = []
     texts = deepcopy(items)
@@ -146,15 +309,6 @@ if __name__ == '__main__':
     res = quick_translate(client, texts=texts[:10], model='gpt-3.5-turbo-0125', prompt=prompt, max_tokens=20)
 
     # try quick translation
-    def easy_clean(x: str):
-        if re.findall(r'id:\d+', x):
-            return np.nan
-
-        if len(re.findall(r'[\d\w]{2,}', x)) == 0:
-            return np.nan
-
-        return x
-
     texts = ing['source'].apply(lambda x: easy_clean(x))
     texts = texts[~texts.isna()].values.tolist()
 
@@ -182,3 +336,7 @@ if __name__ == '__main__':
     # rows should be used for repeated translation
     rows.to_excel(path / 'translated-ing-mapping.xlsx', index=False)
     translated.to_excel(path / 'translated-ing.xlsx', index=False)
+
+    # offline translation for the rest, reusing the mapping and a local model on CPU
+    local = LocalTranslator(path / 'translated-ing-mapping.xlsx', model='facebook/nllb-200-distilled-600M')
+    res = quick_translate(local, items=texts, batch_size=16, workers=2)
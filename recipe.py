@@ -2,3 +2,347 @@
 #
 # Created by Yi on 07/05/2024.
 #
+# The command line driver wires all stages of the pipeline into a dependency graph, where,
+# - a stage depends on the stages that produce its inputs,
+# - a stage is skipped if all its outputs are newer than its inputs (make-style) and,
+#   for stages depending on settings, e.g. `--translator`, the settings are unchanged since the last run,
+# - independent stages, e.g. `compress-ing` and `unit`, run at the same time,
+# - outputs of a failed stage are deleted (like `.DELETE_ON_ERROR` of make).
+#
+# Usage:
+#   python recipe.py                       # run all stages
+#   python recipe.py translate-ing -j 2    # run `translate-ing` and its upstream stages
+#   python recipe.py --dry-run             # show what would be run
+#
+
+import re
+import csv
+import json
+import time
+import argparse
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+from openai import OpenAI
+
+from config import check_ingredients, sparse_ingredients
+from recipe.extract import compress, get_unit
+from nlp.english import CONFIG, CONFIG_FILE, LocalTranslator, easy_clean, quick_translate
+
+
+# stages
+
+
+def merge(inputs: list, outputs: list, args):
+    """Merge all excel recipes into one csv file"""
+    with open(str(outputs[0]), 'w', encoding='utf8', newline='') as csf:
+        # write into csv file by rows
+        writer = csv.writer(csf)
+        for i, file in enumerate(inputs):
+            rec = pd.read_excel(file, engine='openpyxl')
+            if i == 0:
+                writer.writerow(rec.columns.to_list())
+            writer.writerows(rec.values.tolist())
+
+
+def check(inputs: list, outputs: list, args):
+    """Find out recipes with abnormal ingredients which need annotation"""
+    error = pd.DataFrame()
+    for recipe in pd.read_csv(inputs[0], chunksize=10000):
+        recipe = recipe[~recipe['ingredients'].isna()]
+        error = pd.concat([error, check_ingredients(recipe)], axis=0)  # merging by rows
+
+    error.to_excel(outputs[0], index=False)
+
+
+def split(inputs: list, outputs: list, args):
+    """Clean and split ingredients into fine/flaw tables and unique values, skipping the errored recipes"""
+    rfile, efile = inputs
+    fine, flaw, uni_ing, uni_qty = outputs
+    error = pd.read_excel(efile)
+    error_ids = error['recipe_id'].tolist() if 'recipe_id' in error.columns else []
+
+    ing = pd.DataFrame()
+    for recipe in pd.read_csv(rfile, chunksize=10000):
+        recipe = recipe[~recipe['ingredients'].isna()]
+        r = sparse_ingredients(recipe, error_ids)
+        r.columns = ['recipe_id', 'ing', 'qty']
+        ing = pd.concat([ing, r], axis=0)  # merging by rows
+
+    # split fine/flaw datasets
+    count_mask = (ing.iloc[:, 1].isna()) | (ing.iloc[:, 2].isna())
+    ing[count_mask].to_csv(flaw, index=False)
+    ing[~count_mask].to_csv(fine, index=False)
+    print(f'Created {len(ing[count_mask])} rows of flawed data; {len(ing[~count_mask])} rows of fine data!')
+
+    # save unique values
+    pd.DataFrame(ing.ing.unique(), columns=['ing']).to_csv(uni_ing, index=False)
+    pd.DataFrame(ing.qty.unique(), columns=['qty']).to_csv(uni_qty, index=False)
+
+
+def unit(inputs: list, outputs: list, args):
+    """Normalise numeric units of quantities which are not necessarily for translation"""
+    qty = pd.read_csv(inputs[0], encoding='utf8')[['recipe_id', 'ing', 'qty']]
+    # NB. convert unique values only and map them back
+    uni = get_unit(pd.DataFrame({'text': qty['qty'].dropna().unique()}))
+    qty = qty.merge(uni.rename(columns={'text': 'qty'}), on='qty', how='left')
+    qty.to_csv(outputs[0], index=False)
+
+
+def _compress(inputs: list, outputs: list, column: str, d: pd.DataFrame):
+    # NB. `compress` appends to the file, so the stale output must be removed first
+    outputs[0].unlink(missing_ok=True)
+    compress(d[['recipe_id', column]], file=outputs[0])
+
+
+def compress_ing(inputs: list, outputs: list, args):
+    """Compress unique ingredients"""
+    _compress(inputs, outputs, 'ing', pd.read_csv(inputs[0], encoding='utf8'))
+
+
+def compress_qty(inputs: list, outputs: list, args):
+    """Compress unique quantities which cannot be normalised by units"""
+    qty = pd.read_csv(inputs[0], encoding='utf8')
+    _compress(inputs, outputs, 'qty', qty[qty['converted'].isna()])
+
+
+def translate(inputs: list, outputs: list, args):
+    """
+    Translate compressed sources, e.g. `unique-ing.text` into `translated-ing.xlsx`. Translations are
+    cached in a mapping file next to the output, e.g. `translated-ing-mapping.xlsx`, which is reused
+    and extended by every run, so only the misses are sent to the translator.
+
+    :return: str, a note of untranslated entries, if any
+    """
+    rows = [json.loads(it) for it in inputs[0].read_text(encoding='utf8').split('\n') if it]
+    src = pd.DataFrame(rows, columns=['source', 'success', 'error'])
+    texts = src['source'].astype(str).apply(lambda x: easy_clean(x))
+    texts = texts[~texts.isna()].values.tolist()
+
+    # NB. the mapping is a cache rather than an output, so it is kept even if the stage fails
+    mapping = outputs[0].with_name(f'{outputs[0].stem}-mapping.xlsx')
+    table = LocalTranslator(mapping if mapping.exists() else None, model=args.model)
+    if args.translator == 'openai':
+        misses = [t for t in texts if t.strip() not in table.table]
+        if misses:
+            if 'openai-api-key' not in CONFIG:
+                raise ValueError(f'`openai-api-key` is missing in {CONFIG_FILE}, '
+                                 f'which is required to translate {len(misses)} entries')
+
+            client = OpenAI(api_key=CONFIG['openai-api-key'])
+            table.update(quick_translate(client, items=misses, max_input=500, max_tokens=4000,
+                                         model='gpt-3.5-turbo-0125'))
+    else:
+        quick_translate(table, items=texts, batch_size=args.batch_size)
+
+    # save the whole table, not only the hits of this run
+    cache = pd.DataFrame(list(table.table.items()), columns=['source', 'translated'])
+    cache.to_excel(mapping, index=False)
+
+    src['translated'] = src['source'].astype(str).apply(lambda x: table.table.get(x.strip()))
+    src.to_excel(outputs[0], index=False)
+
+    left = src['translated'].isna().sum()
+    return f'{left} of {len(src)} entries untranslated' if left else ''
+
+
+# scheduling
+
+
+class Stage:
+    """
+    A stage of the pipeline, which makes `outputs` from `inputs` by calling `func`.
+    The `settings` are names of command line arguments that change the outputs, e.g. `translator`,
+    and they are stamped next to the first output after each successful run.
+    """
+
+    def __init__(self, name: str, func, inputs: list, outputs: list, settings: list = None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.settings = settings or []
+        self.deps = set()
+
+    @property
+    def stamp(self) -> Path:
+        return self.outputs[0].with_name(f'{self.outputs[0].name}.stamp')
+
+    def get_stamp(self, args) -> str:
+        return json.dumps({k: getattr(args, k) for k in self.settings}, sort_keys=True)
+
+    def is_stale(self, args) -> bool:
+        """Make-style freshness check, i.e. any output is missing or older than any input, or settings changed"""
+        if not all(o.exists() for o in self.outputs):
+            return True
+
+        if self.settings and (not self.stamp.exists() or self.stamp.read_text() != self.get_stamp(args)):
+            return True
+
+        inputs = [i.stat().st_mtime for i in self.inputs if i.exists()]
+        if not inputs:
+            return False  # ... nothing to be rebuilt from
+
+        return max(inputs) > min(o.stat().st_mtime for o in self.outputs)
+
+
+def _excel_recipes(path: Path) -> list:
+    files = path.glob('recipe_*.xlsx')
+    return sorted(files, key=lambda x: int(re.findall(r'\d+', x.stem)[-1]))
+
+
+def get_stages(path: Path) -> dict:
+    """Define all stages under the data directory and resolve dependencies by their inputs/outputs"""
+    stages = [
+        Stage('merge', merge, _excel_recipes(path / 'excel-recipes'), [path / 'recipe_all.csv']),
+        Stage('check', check, [path / 'recipe_all.csv'], [path / 'need-annotation.xlsx']),
+        Stage('split', split, [path / 'recipe_all.csv', path / 'need-annotation.xlsx'],
+              [path / 'fine-ing-table.csv', path / 'flaw-ing-table.csv',
+               path / 'unique-ing.csv', path / 'unique-qty.csv']),
+        # NB. units are normalised before compressing, only the rest are compressed and translated
+        Stage('unit', unit, [path / 'fine-ing-table.csv'], [path / 'unit-qty-table.csv']),
+        Stage('compress-ing', compress_ing, [path / 'fine-ing-table.csv'], [path / 'unique-ing.text']),
+        Stage('compress-qty', compress_qty, [path / 'unit-qty-table.csv'], [path / 'unique-qty.text']),
+        Stage('translate-ing', translate, [path / 'unique-ing.text'], [path / 'translated-ing.xlsx'],
+              settings=['translator', 'model']),
+        Stage('translate-qty', translate, [path / 'unique-qty.text'], [path / 'translated-qty.xlsx'],
+              settings=['translator', 'model']),
+    ]
+
+    producers = {o: s.name for s in stages for o in s.outputs}
+    for s in stages:
+        s.deps = {producers[i] for i in s.inputs if i in producers}
+
+    return {s.name: s for s in stages}
+
+
+def select(stages: dict, targets: list) -> dict:
+    """Select the target stages and all their upstream stages"""
+    selected, todo = set(), list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo += list(stages[name].deps)
+
+    return {k: v for k, v in stages.items() if k in selected}
+
+
+def _run(stage: Stage, args) -> tuple:
+    start = time.perf_counter()
+    for o in stage.outputs:
+        o.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        note = stage.func(stage.inputs, stage.outputs, args)
+    except BaseException:
+        # NB. partial outputs must not be taken as up-to-date in the next run
+        for o in stage.outputs + [stage.stamp]:
+            o.unlink(missing_ok=True)
+        raise
+
+    if stage.settings:
+        stage.stamp.write_text(stage.get_stamp(args))
+
+    return time.perf_counter() - start, note or ''
+
+
+def run(stages: dict, args) -> dict:
+    """
+    Run stages in a topological order with a pool of processes, and a stage is submitted
+    once all its upstream stages are done. Freshness is checked right before submission
+    so that the outputs of upstream stages are taken into account.
+
+    :param stages: a dict of stages
+    :param args: parsed arguments of the command line
+    :return: dict, the status, timing and note of each stage
+    """
+    report = {}
+    pending = dict(stages)
+    running = {}
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        while pending or running:
+            # submit the ready stages
+            for name, stage in list(pending.items()):
+                if any(d not in report for d in stage.deps):
+                    continue
+
+                pending.pop(name)
+                failed = [d for d in stage.deps if report[d][0] in ['failed', 'skipped']]
+                if failed:
+                    print(f'[{name}] skipped, because of failed upstream: {", ".join(failed)}')
+                    report[name] = ('skipped', 0.0, '')
+                elif args.dry_run:
+                    # NB. outputs are not rebuilt in a dry run, so the downstream of a stale stage is stale too
+                    stale = args.force or stage.is_stale(args) or any(report[d][0] == 'stale' for d in stage.deps)
+                    print(f'[{name}] {"would run" if stale else "up-to-date"}')
+                    report[name] = ('stale' if stale else 'fresh', 0.0, '')
+                elif not args.force and not stage.is_stale(args):
+                    print(f'[{name}] up-to-date')
+                    report[name] = ('fresh', 0.0, '')
+                else:
+                    missing = [str(i) for i in stage.inputs if not i.exists()]
+                    if missing or not stage.inputs:
+                        print(f'[{name}] failed, missing inputs: {", ".join(missing) or "none found"}')
+                        report[name] = ('failed', 0.0, '')
+                        continue
+
+                    print(f'[{name}] started')
+                    running[pool.submit(_run, stage, args)] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    elapsed, note = future.result()
+                    print(f'[{name}] done in {elapsed:.2f}s' + (f', {note}' if note else ''))
+                    report[name] = ('done', elapsed, note)
+                except Exception as e:
+                    print(f'[{name}] failed: {e}')
+                    report[name] = ('failed', 0.0, '')
+
+    return report
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Run the Recipe170 processing pipeline.')
+    parser.add_argument('targets', nargs='*', help='stages to run with their upstream stages, default all')
+    parser.add_argument('-d', '--data', type=Path, default=Path('data'), help='data directory, default `data`')
+    parser.add_argument('-j', '--jobs', type=int, default=2, help='number of stages running at the same time')
+    parser.add_argument('-f', '--force', action='store_true', help='run stages even if they are up-to-date')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only show the stages to be run')
+    parser.add_argument('--translator', choices=['local', 'openai'], default='local',
+                        help='translation backend, default `local`')
+    parser.add_argument('--model', default=None,
+                        help='local translation model, e.g. `facebook/nllb-200-distilled-600M`, '
+                             'default None (mapping only)')
+    parser.add_argument('--batch-size', type=int, default=32, help='batch size of local translation')
+    args = parser.parse_args(argv)
+
+    stages = get_stages(args.data)
+    unknown = [t for t in args.targets if t not in stages]
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(unknown)}, choose from {", ".join(stages)}')
+
+    start = time.perf_counter()
+    report = run(select(stages, args.targets or list(stages)), args)
+
+    # summarise in the order of stages
+    print(f'\n{"stage":<16}{"status":<10}{"time":>10}')
+    for name in stages:
+        if name in report:
+            status, elapsed, note = report[name]
+            print(f'{name:<16}{status:<10}{elapsed:>9.2f}s  {note}'.rstrip())
+    print(f'Total: {time.perf_counter() - start:.2f}s')
+
+    return 1 if any(status == 'failed' for status, _, _ in report.values()) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -172,7 +172,7 @@ def get_unit(qty: pd.DataFrame):
     :return: pd.DataFrame
     """
     # convert units into standards
-    qty['converted'] = qty['text'].apply(lambda x: _numeric_unit(x), axis=1)
+    qty['converted'] = qty['text'].apply(lambda x: _numeric_unit(str(x)))
     return qty
 
 